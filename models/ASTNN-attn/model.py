@@ -24,57 +24,83 @@ class BatchTreeEncoder(nn.Module):
 
 
     def traverse_mul(self, node, batch_index):
+        # node holds the forest rows encoded by this call, batch_index their statements
         size = len(node)
         if not size:
             return None
-        batch_current = variable(torch.zeros(size, self.encode_dim), self.use_gpu)
-
-        index, children_index = [], []
-        current_node, children = [], []
-        for i in range(size):
-            # if node[i][0] is not -1:
-            index.append(i)
-            current_node.append(node[i][0])
-            temp = node[i][1: 3]  #限制个数，递归部分，限制子树深度
-            c_num = len(temp)
-            for j in range(c_num):
-                if temp[j][0] != -1:
-                    if len(children_index) <= j:
-                        children_index.append([i])
-                        children.append([temp[j]])
-                    else:
-                        children_index[j].append(i)
-                        children[j].append(temp[j])
-            # else:
-            #     batch_index[i] = -1
-
-        batch_current = self.W_c(batch_current.index_copy(0, variable(torch.LongTensor(index), self.use_gpu),
-                    self.embedding(variable(torch.LongTensor(current_node), self.use_gpu))))
-
-        for c in range(len(children)):
-            zeros = variable(torch.zeros(size, self.encode_dim), self.use_gpu)
-            batch_children_index = [batch_index[i] for i in children_index[c]]
-            tree = self.traverse_mul(children[c], batch_children_index)
+
+        batch_current = self.W_c(self.embedding(self.token[node]))
+
+        # the children of the nodes are encoded by one call per child slot. The first child met goes to the
+        # first call even when it is a second child, as in the traversal of the nested lists
+        children = self.node_children[node]
+        exists = children.ge(0)
+        group = torch.arange(2, device=node.device).repeat(size, 1)
+        group.view(-1)[exists.view(-1).nonzero()[:1, 0]] = 0
+        for c in range(2):
+            children_index, slot = (group.eq(c) & exists).nonzero(as_tuple=True)
+            tree = self.traverse_mul(children[children_index, slot], batch_index[children_index])
             if tree is not None:
-                batch_current += zeros.index_copy(0, variable(torch.LongTensor(children_index[c]), self.use_gpu), tree)
+                batch_current = batch_current.index_add(0, children_index, tree)
         # batch_current = F.tanh(batch_current)
-        batch_index = [i for i in batch_index if i != -1]
-        b_in = variable(torch.LongTensor(batch_index), self.use_gpu)
-        self.node_list.append(self.batch_node.index_copy(0, b_in, batch_current))
+        self.node_list.append(self.batch_node.index_copy(0, batch_index, batch_current))
         return batch_current
 
     def forward(self, x, bs):
+        # x is a forest of (token, parent, slot, depth, statement) rows (see collate_asts), bs its number
+        # of statements
         self.batch_size = bs
         self.batch_node = variable(torch.zeros(self.batch_size, self.encode_dim), self.use_gpu)
         self.node_list = []
-        self.traverse_mul(x, list(range(self.batch_size)))
+        self.token = x[:, 0]
+        parent, slot = x[:, 1], x[:, 2]
+        child = parent.ge(0).nonzero().view(-1)
+        self.node_children = torch.full((len(x), 2), -1, dtype=torch.long, device=x.device)
+        self.node_children[parent[child], slot[child]] = child
+        root = parent.lt(0).nonzero().view(-1)
+        self.traverse_mul(root, x[root, 4])
         self.node_list = torch.stack(self.node_list)
         return torch.max(self.node_list, 0)[0]
 
+class LevelTreeEncoder(BatchTreeEncoder):
+    # the encoding of BatchTreeEncoder without recursion: the nodes of all statements are embedded at once,
+    # then added to their parents one depth level at a time, deepest first
+    def forward(self, x, bs):
+        token, parent, slot, depth, statement = x[:, 0], x[:, 1], x[:, 2], x[:, 3], x[:, 4]
+        node = self.W_c(self.embedding(token))
+
+        levels = torch.split(torch.argsort(depth, stable=True), torch.bincount(depth).tolist())
+        for level in reversed(levels[1:]):
+            node = node.index_add(0, parent[level], node[level])
+
+        # the traverse_mul call of BatchTreeEncoder encoding every node: the roots are in the first call, the
+        # children of the nodes of a call in one call per child slot, but the first child of the call in the
+        # first one. A call holds at most one node of a statement, the rows of a call are in statement order
+        call = torch.zeros_like(token)
+        num_calls = 1
+        for level in levels[1:]:
+            parent_call = call[parent[level]]
+            child_key = parent[level] * 2 + slot[level]
+            first = torch.full((num_calls,), len(x) * 2, dtype=torch.long, device=x.device)
+            first = first.scatter_reduce(0, parent_call, child_key, 'amin')
+            group = torch.where(child_key.eq(first[parent_call]), 0, slot[level])
+            calls, level_call = torch.unique(parent_call * 2 + group, return_inverse=True)
+            call[level] = level_call + num_calls
+            num_calls += len(calls)
+
+        # max over the nodes of every statement. BatchTreeEncoder takes the max over its calls and puts zeros
+        # for the statements a call does not reach, so the max is floored at zero for the statements with
+        # fewer nodes than there are calls
+        batch_node = variable(torch.zeros(bs, self.encode_dim), self.use_gpu)
+        batch_node = batch_node.scatter_reduce(0, statement.unsqueeze(1).expand_as(node), node, 'amax',
+                                               include_self=False)
+        floor = torch.bincount(statement, minlength=bs).lt(num_calls).unsqueeze(1)
+        return torch.where(floor, torch.clamp(batch_node, min=0), batch_node)
+
 class MODEL(nn.Module):
     def __init__(self, num_concepts, num_problems, hidden_dim, hidden_layers,
                  concept_embed_dim, ast_embed_dim, max_tokens, ast_encode_dim,
-                 ast_pretrained_weight, max_len, batch_size, gpu):
+                 ast_pretrained_weight, max_len, batch_size, gpu, tree_encoder='level'):
         super(MODEL, self).__init__()
 
         self.hidden_dim = hidden_dim
@@ -90,8 +116,9 @@ class MODEL(nn.Module):
         self.p_id_embed = nn.Embedding(num_problems + 1, concept_embed_dim)
 
         # class "BatchTreeEncoder"
-        self.encoder = BatchTreeEncoder(max_tokens, ast_embed_dim, ast_encode_dim,
-                                        batch_size, gpu, ast_pretrained_weight)
+        encoder = LevelTreeEncoder if tree_encoder == 'level' else BatchTreeEncoder
+        self.encoder = encoder(max_tokens, ast_embed_dim, ast_encode_dim,
+                               batch_size, gpu, ast_pretrained_weight)
         if self.gpu == 0:
             self.encoder.cuda()
 
@@ -116,10 +143,6 @@ class MODEL(nn.Module):
         nn.init.kaiming_normal_(self.transdim.weight)
 
 
-    def get_zeros(self, num):
-        zeros = variable(torch.zeros(num, self.ast_encode_dim), self.gpu)
-        return zeros
-
     def attention(self, c_id, c_embed, gru_input, bs, seqlen):
 
         gru_input = self.transdim(gru_input)
@@ -143,7 +166,7 @@ class MODEL(nn.Module):
         return c_p_attn_out
 
 
-    def forward(self, p_id, c_id, ast, target_c, result, c_embed, cur_result):
+    def forward(self, p_id, c_id, code_index, num_codes, tree, statement, target_c, result, c_embed, cur_result, lengths=None, status=None):
         bs = p_id.shape[0]
         seqlen = p_id.shape[1]
 
@@ -151,40 +174,20 @@ class MODEL(nn.Module):
         # models
         # p_id_embed = self.p_id_embed(p_id)
 
-        batch_encodes = []
-        for idx in range(bs):
-            lens = [len(item) for item in ast[idx]]
-
-            encodes = []
-            for i in range(len(ast[idx])):
-                for j in range(lens[i]):
-                    encodes.append(ast[idx][i][j])
-
-            encodes = self.encoder(encodes, sum(lens))
-            seq, start, end = [], 0, 0
-            for i in range(len(ast[idx])):
-                end += lens[i]
-                if self.max_len - lens[i] > 0:
-                    seq.append(self.get_zeros(self.max_len - lens[i]))
-                    seq.append(encodes[start: end])
-                else:
-                    seq.append(encodes[start: start + self.max_len])
-                start = end
-            encodes = torch.cat(seq)
-            encodes = encodes.view(len(ast[idx]), self.max_len, -1)
-            batch_encodes.append(encodes)
-
-        gru_input = variable(torch.zeros(bs, seqlen, self.max_len, self.ast_encode_dim), self.gpu)
-        for i in range(bs):
-            dat = batch_encodes[i]
-            gru_input[i, :dat.shape[0], :dat.shape[1], :] = dat
-
-        attn_out = self.attention(c_id, c_embed, gru_input, bs, seqlen)
+        # tree holds the statement trees of the distinct codes of the batch, which are all encoded by one encoder
+        # call and written to their (code, position) of statement; code_index picks the code of every
+        # (student, step) cell among the num_codes codes of the batch
+
+        encodes = self.encoder(tree, len(statement))
+        gru_input = variable(torch.zeros(num_codes, self.max_len, self.ast_encode_dim), self.gpu)
+        gru_input[statement[:, 0], statement[:, 1]] = encodes
+
+        attn_out = self.attention(c_id, c_embed, gather_codes(gru_input, code_index), bs, seqlen)
 
         LSTM_input = torch.cat([c_embed, attn_out, cur_result], 2)
 
         # LSTM
-        LSTM_out, final_status = self.LSTM(LSTM_input)
+        LSTM_out, final_status = run_lstm(self.LSTM, LSTM_input, lengths, status)
         LSTM_out = LSTM_out.contiguous()
 
         #######################################################################################################
@@ -192,18 +195,18 @@ class MODEL(nn.Module):
 
         # 多知识点，除以知识点个数
         num_concepts = torch.sum(target_c, 2).view(-1)
-
-        prediction = self.predict_Linear(LSTM_out.view(bs * seqlen, -1))  # 去掉dropout
-        prediction_1d = torch.bmm(prediction.unsqueeze(1),
-                                  target_c.view(bs * seqlen, -1).unsqueeze(2)).squeeze(2)
+        # only the steps with a target problem are predicted
         mask = num_concepts.gt(0)
         num_concepts = torch.masked_select(num_concepts, mask)
-        filtered_pred = torch.masked_select(prediction_1d.squeeze(1), mask)
-        filtered_pred = torch.div(filtered_pred, num_concepts)
+
+        prediction = self.predict_Linear(LSTM_out.view(bs * seqlen, -1)[mask])  # 去掉dropout
+        prediction_1d = torch.bmm(prediction.unsqueeze(1),
+                                  target_c.view(bs * seqlen, -1)[mask].unsqueeze(2)).squeeze(2)
+        filtered_pred = torch.div(prediction_1d.squeeze(1), num_concepts)
         filtered_target = torch.masked_select(result.squeeze(1), mask)
         loss = F.binary_cross_entropy_with_logits(filtered_pred, filtered_target)
 
 
-        return loss, torch.sigmoid(filtered_pred), filtered_target
+        return loss, torch.sigmoid(filtered_pred), filtered_target, final_status
 
 
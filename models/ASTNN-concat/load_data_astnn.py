@@ -2,36 +2,110 @@ import numpy as np
 from tqdm import tqdm
 import math
 import json
+import hashlib
+from itertools import chain, islice
+from multiprocessing import Pool
+
+import utils
+
+
+def flatten(sequences, dtype=np.int64):
+    return np.fromiter(chain.from_iterable(sequences), dtype=dtype)
+
+
+def flat_lens(sequences):
+    # length of every element of every sequence
+    return np.fromiter((len(item) for seq in sequences for item in seq), dtype=np.int64)
+
+
+def flat_index(sequences):
+    # (row, step) position of every element of a list of sequences
+    lens = np.fromiter((len(seq) for seq in sequences), dtype=np.int64, count=len(sequences))
+    rows = np.repeat(np.arange(len(sequences)), lens)
+    steps = np.arange(lens.sum()) - np.repeat(np.cumsum(lens) - lens, lens)
+    return rows, steps
+
 
 class DATA_astnn():
-    def __init__(self, num_concepts, seqlen, separate_char=';'):
+    # bump when the arrays returned by load_data change, invalidates old caches
+    cache_version = 7
+    # students per chunk handed to a parsing worker
+    chunk_size = 64
+
+    def __init__(self, num_concepts, seqlen, separate_char=';', use_cache=True, workers=1):
         super(DATA_astnn, self).__init__()
 
         self.n_concept = num_concepts
         self.seqlen = seqlen
         self.separate_char = separate_char
+        self.use_cache = use_cache
+        self.workers = workers
 
     def load_data(self, path):
-        f_data = open(path, 'r')
-        seq_len_data = []
-        p_id_data = []
-        c_id_data = []
-        result_data = []
-        target_c_data = []
-        x_result_data = []
-        ast_data = []
+        # parsed arrays are cached on disk and memory-mapped on later runs
+        if not self.use_cache:
+            return self.parse_data(path)
 
-        for lineID, line in enumerate(tqdm(f_data)):
+        cache_dir = utils.cache_path(path, 'astnn', self.cache_version, self.seqlen, self.n_concept)
+        data = utils.load_cache(cache_dir)
+        if data is None:
+            data = self.parse_data(path)
+            utils.save_cache(cache_dir, data)
+        return data
 
-            # if lineID > 1023:
-            #     continue
+    def parse_data(self, path):
+        if self.workers <= 1:
+            return self.build_arrays(*self.parse_codes(self.read_records(path)))
 
-            line = line.strip()
-            if lineID % 8 == 0:
-                line = line.split(',')
-                seq_len_data.append(int(line[1]))
+        # chunks of whole students are parsed in a process pool, imap returns them in file order so the
+        # arrays are the same as the serial ones
+        records = []
+        codes = {}
+        with Pool(self.workers) as pool:
+            for chunk_records, chunk_codes in tqdm(pool.imap(self.parse_chunk, self.read_chunks(path))):
+                records.extend(chunk_records)
+                codes.update(chunk_codes)
+        return self.build_arrays(records, codes)
+
+    def stream_data(self, path, batch_size, buffer_size=0):
+        # batches in the format of load_data, built while the file is read. The rows are shuffled through
+        # a buffer of buffer_size rows (0 keeps the file order), the last incomplete batch is dropped
+        rows = self.read_records(path)
+        if buffer_size > 0:
+            rows = utils.shuffle_buffer(rows, buffer_size)
+
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_size:
+                yield self.build_arrays(*self.parse_codes(batch))
+                batch = []
+
+    def read_records(self, path):
+        with open(path, 'r') as f_data:
+            for record in self.split_records(tqdm(f_data)):
+                yield record
+
+    def read_chunks(self, path):
+        # the lines of chunk_size students at a time
+        with open(path, 'r') as f_data:
+            while True:
+                lines = list(islice(f_data, 8 * self.chunk_size))
+                if not lines:
+                    return
+                yield lines
+
+    def parse_chunk(self, lines):
+        return self.parse_codes(self.split_records(lines))
 
-            elif lineID % 8 == 1:
+    def split_records(self, lines):
+        # every student takes 8 lines, yields its rows of at most seqlen + 1 interactions as
+        # (problem ids, concept tags, code texts, results, rows of the student before it), the codes are
+        # parsed by parse_codes
+        for lineID, line in enumerate(lines):
+
+            line = line.strip()
+            if lineID % 8 == 1:
                 problem_id = []
                 P = line.split(self.separate_char)
                 if len(P[len(P) - 1]) == 0:
@@ -50,12 +124,7 @@ class DATA_astnn():
                     c_tags.append(tag)
 
             elif lineID % 8 == 4:
-                line = line.split(self.separate_char)
-                asts = []
-                for i in range(len(line)):
-                    ast = json.loads(line[i])
-                    # asts.append(ast)
-                    asts.append(ast[:min(len(ast), 30)])  # 一个代码最多取30个ast输入
+                codes = line.split(self.separate_char)
 
             elif lineID % 8 == 6:
                 result = []
@@ -72,12 +141,12 @@ class DATA_astnn():
                     if len(problem_id) % new_seq_len:
                         n_split = n_split + 1
 
-
+                chunk = 0
                 for k in range(n_split):
                     p_id_sequence = []
                     c_id_sequence = []
+                    code_sequence = []
                     result_sequence = []
-                    ast_sequence = []
 
                     if k == n_split - 1:
                         end_index = len(problem_id)
@@ -87,54 +156,113 @@ class DATA_astnn():
                         if problem_id[i] > 0:
                             p_id_sequence.append(int(problem_id[i]))
                             c_id_sequence.append(c_tags[i])
+                            code_sequence.append(codes[i])
                             result_sequence.append(result[i])
-                            ast_sequence.append(asts[i])
 
                     if len(p_id_sequence) > 2:
-                        p_id_data.append(p_id_sequence[:-1])
-                        c_id_data.append(c_id_sequence[:-1])
-                        result_data.append(result_sequence[1:])
-                        target_c_data.append(c_id_sequence[1:])
-                        x_result_data.append(result_sequence[:-1])
-                        ast_data.append(ast_sequence[:-1])
-
-        f_data.close()
-
-        p_id_dataArray = np.zeros((len(p_id_data), self.seqlen))
-        for i in range(len(p_id_data)):
-            dat = p_id_data[i]
-            p_id_dataArray[i, :len(dat)] = dat
-
-        # onehot形式
-        c_id_dataArray = np.zeros((len(c_id_data), self.seqlen, 2 * self.n_concept + 1))
-        for i in range(len(c_id_data)):
-            for j in range(len(c_id_data[i])):
-                for k in range(len(c_id_data[i][j])):
-                    c_id_dataArray[i, j, c_id_data[i][j][k] + x_result_data[i][j] * self.n_concept] = 1
-
-        c_embed_dataArray = np.zeros((len(c_id_data), self.seqlen, self.n_concept + 1))
-        for i in range(len(c_id_data)):
-            for j in range(len(c_id_data[i])):
-                for k in range(len(c_id_data[i][j])):
-                    c_embed_dataArray[i, j, c_id_data[i][j][k]] = 1
+                        yield p_id_sequence, c_id_sequence, code_sequence, result_sequence, chunk
+                        chunk += 1
+
+    def parse_codes(self, records):
+        # replaces the codes of the rows by their sha1, returns the rows and the parsed code of every sha1.
+        # identical submissions are parsed once
+        keyed_records = []
+        codes = {}
+        for p_id_sequence, c_id_sequence, code_sequence, result_sequence, chunk in records:
+            keys = []
+            for code in code_sequence[:-1]:
+                key = hashlib.sha1(code.encode()).digest()
+                if key not in codes:
+                    codes[key] = self.parse_code(code)
+                keys.append(key)
+            keyed_records.append((p_id_sequence, c_id_sequence, keys, result_sequence, chunk))
+        return keyed_records, codes
+
+    def parse_code(self, code):
+        # statement trees of a submission flattened in preorder, one (token, parent, slot, depth) row per node.
+        # parent is the row of the parent node in the submission (-1 for the statement roots) and slot the
+        # position of the node among its children. The encoders only use the first two children of a node
+        # and skip the children marked -1, so those are not stored
+        nodes = []
+        for tree in json.loads(code)[:30]:  # 一个代码最多取30个ast输入
+            stack = [(tree, -1, 0, 0)]
+            while stack:
+                node, parent, slot, depth = stack.pop()
+                nodes.append((node[0], parent, slot, depth))
+                for child_slot in (1, 0):
+                    if child_slot + 1 < len(node) and node[child_slot + 1][0] != -1:
+                        stack.append((node[child_slot + 1], len(nodes) - 1, child_slot, depth + 1))
+        return np.array(nodes, dtype=np.int32).reshape(-1, 4)
+
+    def build_arrays(self, records, codes):
+        # the arrays of load_data from the rows and parsed codes of parse_codes
+        p_id_data = []
+        c_id_data = []
+        code_id_data = []
+        result_data = []
+        target_p_id_data = []
+        target_c_data = []
+        x_result_data = []
+        chunk_data = []
+        # table of distinct submissions, interactions only keep an index into it; code 0 is the padding
+        ast_table = [np.zeros((0, 4), dtype=np.int32)]
+        code_index = {}
+
+        for p_id_sequence, c_id_sequence, code_sequence, result_sequence, chunk in records:
+            code_ids = []
+            for key in code_sequence:
+                # identical submissions are stored once
+                if key not in code_index:
+                    code_index[key] = len(ast_table)
+                    ast_table.append(codes[key])
+
+                code_ids.append(code_index[key])
+
+            p_id_data.append(p_id_sequence[:-1])
+            c_id_data.append(c_id_sequence[:-1])
+            code_id_data.append(code_ids)
+            result_data.append(result_sequence[1:])
+            target_p_id_data.append(p_id_sequence[1:])
+            target_c_data.append(c_id_sequence[1:])
+            x_result_data.append(result_sequence[:-1])
+            chunk_data.append(chunk)
+
+        # (row, step) of every interaction, shared by all per-step arrays
+        rows, steps = flat_index(p_id_data)
+
+        p_id_dataArray = np.zeros((len(p_id_data), self.seqlen), dtype=np.int32)
+        p_id_dataArray[rows, steps] = flatten(p_id_data)
+
+        target_p_id_dataArray = np.zeros((len(target_p_id_data), self.seqlen), dtype=np.int32)
+        target_p_id_dataArray[rows, steps] = flatten(target_p_id_data)
+
+        # the concept tags only depend on the problem: one multi-hot row per problem id, row 0 stays empty
+        # for the padding. The onehot inputs of the models are gathered from it per batch
+        p_ids = np.concatenate([flatten(p_id_data), flatten(target_p_id_data)])
+        n_tags = np.concatenate([flat_lens(c_id_data), flat_lens(target_c_data)])
+        tags = flatten(chain(chain.from_iterable(c_id_data), chain.from_iterable(target_c_data)))
+
+        concept_dataArray = np.zeros((p_ids.max(initial=0) + 1, self.n_concept + 1), dtype=np.uint8)
+        concept_dataArray[np.repeat(p_ids, n_tags), tags] = 1
+
+        # interaction (i, j) submitted code code_id_dataArray[i, j], whose flattened statement trees are
+        # ast_node_dataArray[node_offset_dataArray[code]: node_offset_dataArray[code + 1]]
+        code_id_dataArray = np.zeros((len(code_id_data), self.seqlen), dtype=np.int32)
+        code_id_dataArray[rows, steps] = flatten(code_id_data)
+        node_offset_dataArray = np.concatenate([[0], np.cumsum([len(code) for code in ast_table])])
+        ast_node_dataArray = np.concatenate(ast_table)
 
         # target and label
-        target_c_dataArray = np.zeros((len(target_c_data), self.seqlen, self.n_concept + 1))
-        for i in range(len(target_c_data)):
-            for j in range(len(target_c_data[i])):
-                target_c_dataArray[i, j, target_c_data[i][j]] = 1
+        result_dataArray = np.zeros((len(result_data), self.seqlen), dtype=np.uint8)
+        result_dataArray[rows, steps] = flatten(result_data)
 
-        result_dataArray = np.zeros((len(result_data), self.seqlen))
-        for i in range(len(result_data)):
-            dat = result_data[i]
-            result_dataArray[i, :len(dat)] = dat
+        x_result_dataArray = np.zeros((len(x_result_data), self.seqlen), dtype=np.uint8)
+        x_result_dataArray[rows, steps] = flatten(x_result_data)
 
-        x_result_dataArray = np.zeros((len(x_result_data), self.seqlen, 2))
-        for i in range(len(x_result_data)):
-            for j in range(len(x_result_data[i])):
-                x_result_dataArray[i, j, x_result_data[i][j]] = 1
+        # the number of rows of the same student before every row, the rows of a student follow each other
+        chunk_dataArray = np.array(chunk_data, dtype=np.int32)
 
 
-        return p_id_dataArray, c_id_dataArray, ast_data, \
-               target_c_dataArray, result_dataArray, c_embed_dataArray, x_result_dataArray
+        return p_id_dataArray, target_p_id_dataArray, code_id_dataArray, ast_node_dataArray, node_offset_dataArray, \
+               result_dataArray, x_result_dataArray, chunk_dataArray, concept_dataArray
 
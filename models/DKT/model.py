@@ -72,8 +72,9 @@ class MODEL(nn.Module):
 
     def preprocess(self, paths, starts, ends):
         # 取前n个path
-        if self.np < 200:
-            sample = random.sample(range(0, 200), self.np)
+        num_paths = paths.shape[2]
+        if self.np < num_paths:
+            sample = random.sample(range(0, num_paths), self.np)
             paths = paths[:, :, sample]
             starts = starts[:, :, sample]
             ends = ends[:, :, sample]
@@ -91,7 +92,7 @@ class MODEL(nn.Module):
         return context_embedded, starts, paths, ends, paths_embedded
 
 
-    def forward(self, p_id, c_id, starts, paths, ends, masks, target_c, result, c_embed, cur_result):
+    def forward(self, p_id, c_id, code_index, starts, paths, ends, masks, target_c, result, c_embed, cur_result, lengths=None, status=None):
         bs = p_id.shape[0]
         seqlen = p_id.shape[1]
 
@@ -102,7 +103,7 @@ class MODEL(nn.Module):
         LSTM_input = torch.cat([c_embed, cur_result], 2)
 
         # LSTM
-        LSTM_out, final_status = self.LSTM(LSTM_input)
+        LSTM_out, final_status = run_lstm(self.LSTM, LSTM_input, lengths, status)
         LSTM_out = LSTM_out.contiguous()
 
         #######################################################################################################
@@ -110,17 +111,17 @@ class MODEL(nn.Module):
 
         # 多知识点，除以知识点个数
         num_concepts = torch.sum(target_c, 2).view(-1)
-
-        prediction = self.predict_Linear(LSTM_out.view(bs * seqlen, -1))  # 去掉dropout
-        prediction_1d = torch.bmm(prediction.unsqueeze(1),
-                                  target_c.view(bs * seqlen, -1).unsqueeze(2)).squeeze(2)
+        # only the steps with a target problem are predicted
         mask = num_concepts.gt(0)
         num_concepts = torch.masked_select(num_concepts, mask)
-        filtered_pred = torch.masked_select(prediction_1d.squeeze(1), mask)
-        filtered_pred = torch.div(filtered_pred, num_concepts)
+
+        prediction = self.predict_Linear(LSTM_out.view(bs * seqlen, -1)[mask])  # 去掉dropout
+        prediction_1d = torch.bmm(prediction.unsqueeze(1),
+                                  target_c.view(bs * seqlen, -1)[mask].unsqueeze(2)).squeeze(2)
+        filtered_pred = torch.div(prediction_1d.squeeze(1), num_concepts)
         filtered_target = torch.masked_select(result.squeeze(1), mask)
         loss = F.binary_cross_entropy_with_logits(filtered_pred, filtered_target)
 
-        return loss, torch.sigmoid(filtered_pred), filtered_target
+        return loss, torch.sigmoid(filtered_pred), filtered_target, final_status
 
 
@@ -1,11 +1,11 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch_geometric.nn import MessagePassing,GatedGraphConv
+from torch_geometric.nn import GatedGraphConv
 from torch_geometric.nn.glob import GlobalAttention
+from torch_geometric.utils import to_dense_batch
 
 from utils import *
-import random
 
 class MODEL(nn.Module):
     def __init__(self, num_concepts, num_problems, hidden_dim, hidden_layers,
@@ -50,7 +50,7 @@ class MODEL(nn.Module):
         nn.init.constant_(self.predict_Linear.bias, 0)
         nn.init.kaiming_normal_(self.transdim.weight)
 
-    def attention(self, c_id, c_embed, ggnn, bs, seqlen):
+    def attention(self, c_id, c_embed, ggnn, node_mask, bs, seqlen):
         ggnn = self.transdim(ggnn)
         num_nodes = ggnn.shape[2]
 
@@ -64,7 +64,10 @@ class MODEL(nn.Module):
         c_p_attn_weight = torch.bmm(concept_query.view(bs * seqlen, self.num_concepts + 1, self.concept_embed_dim),
                                     ggnn.view(bs * seqlen, num_nodes,
                                                    self.concept_embed_dim).permute(0, 2, 1))
-        c_p_attn_weight = torch.softmax(c_p_attn_weight, dim=2)
+        # padded node slots get no weight, cells without a graph attend to nothing
+        node_mask = node_mask.view(bs * seqlen, 1, num_nodes)
+        c_p_attn_weight = c_p_attn_weight.masked_fill(~node_mask, -1e9)
+        c_p_attn_weight = torch.softmax(c_p_attn_weight, dim=2) * node_mask
         c_p_attn_out = torch.bmm(c_p_attn_weight, ggnn.view(bs * seqlen, num_nodes, self.concept_embed_dim))
         c_p_attn_out = c_p_attn_out * c_embed.view(bs * seqlen, self.num_concepts + 1, self.concept_embed_dim)
         c_p_attn_out = torch.sum(c_p_attn_out, dim=1) / num.view(-1).unsqueeze(1)
@@ -73,42 +76,32 @@ class MODEL(nn.Module):
         return c_p_attn_out
 
 
-    def forward(self, p_id, c_id, node_id, edge, edge_type, target_c, result, c_embed, cur_result):
+    def forward(self, p_id, c_id, node_id, edge, edge_type, node_batch, code_index, num_codes, target_c, result, c_embed, cur_result, lengths=None, status=None):
         bs = p_id.shape[0]
         seqlen = p_id.shape[1]
-        nodelen = node_id.shape[2]
-
-        if self.num_nodes < 200:
-            sample = random.sample(range(0, node_id.shape[2]), 50)
-            nodelen = len(sample)
-            node_id = node_id[:, :, sample]
-            edge = edge[:, :, :, sample]
-            edge_type = edge_type[:, :, sample]
 
         #####################################################################################################
         # ggnn
-        node_embed = self.node_embed(node_id).view(bs, seqlen, nodelen, -1)
-        edge_weight = self.edge_embed(edge_type).mean(3).unsqueeze(3)
+        # node_id, edge and edge_type hold the graphs of the distinct codes of the batch merged into one graph,
+        # node_batch maps every node to one of the num_codes codes and code_index every (student, step) cell to its code
+        node_embed = self.node_embed(node_id)
+        edge_weight = self.edge_embed(edge_type).mean(1)
 
-        batch_ggnn = []
-        for i in range(bs):
-            ggnn = []
-            for j in range(seqlen):
-                out = self.ggnnlayer(node_embed[i, j], edge[i, j], edge_weight[i, j])
-                ggnn.append(out)
-            ggnn = torch.cat([ggnn[i].unsqueeze(0) for i in range(seqlen)], 0)
-            batch_ggnn.append(ggnn)
+        # the graphs are disjoint, so one convolution over the merged graph convolves each of them
+        out = self.ggnnlayer(node_embed, edge, edge_weight)
 
-        batch_ggnn = torch.cat([batch_ggnn[i].unsqueeze(0) for i in range(bs)], 0)
+        # (bs, seqlen, largest graph of the batch, node_embed_dim)
+        batch_ggnn, node_mask = to_dense_batch(out, node_batch, batch_size=num_codes)
+        batch_ggnn, node_mask = gather_codes(batch_ggnn, code_index), gather_codes(node_mask, code_index)
 
-        attn_out = self.attention(c_id, c_embed, batch_ggnn, bs, seqlen)
+        attn_out = self.attention(c_id, c_embed, batch_ggnn, node_mask, bs, seqlen)
 
         # PKT
         # p_id_embed = self.p_id_embed(p_id)
         LSTM_input = torch.cat([c_embed, attn_out, cur_result], 2)
 
         # LSTM
-        LSTM_out, final_status = self.LSTM(LSTM_input)
+        LSTM_out, final_status = run_lstm(self.LSTM, LSTM_input, lengths, status)
         LSTM_out = LSTM_out.contiguous()
 
         #######################################################################################################
@@ -116,17 +109,17 @@ class MODEL(nn.Module):
 
         # 多知识点，除以知识点个数
         num_concepts = torch.sum(target_c, 2).view(-1)
-
-        prediction = self.predict_Linear(LSTM_out.view(bs * seqlen, -1))  # 去掉dropout
-        prediction_1d = torch.bmm(prediction.unsqueeze(1),
-                                  target_c.view(bs * seqlen, -1).unsqueeze(2)).squeeze(2)
+        # only the steps with a target problem are predicted
         mask = num_concepts.gt(0)
         num_concepts = torch.masked_select(num_concepts, mask)
-        filtered_pred = torch.masked_select(prediction_1d.squeeze(1), mask)
-        filtered_pred = torch.div(filtered_pred, num_concepts)
+
+        prediction = self.predict_Linear(LSTM_out.view(bs * seqlen, -1)[mask])  # 去掉dropout
+        prediction_1d = torch.bmm(prediction.unsqueeze(1),
+                                  target_c.view(bs * seqlen, -1)[mask].unsqueeze(2)).squeeze(2)
+        filtered_pred = torch.div(prediction_1d.squeeze(1), num_concepts)
         filtered_target = torch.masked_select(result.squeeze(1), mask)
         loss = F.binary_cross_entropy_with_logits(filtered_pred, filtered_target)
 
-        return loss, torch.sigmoid(filtered_pred), filtered_target
+        return loss, torch.sigmoid(filtered_pred), filtered_target, final_status
 
 
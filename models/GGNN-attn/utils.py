@@ -1,12 +1,19 @@
+import hashlib
 import json
+import os
 
+import numpy as np
+import torch
+import torch.nn.functional as F
 import torch.nn.init
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from torch.autograd import Variable
+from torch.utils.data import DataLoader, Dataset, IterableDataset
 
 
 def variable(tensor, gpu):
     if gpu >= 0:
-        return Variable(tensor).cuda()
+        return Variable(tensor).cuda(non_blocking=True)
     else:
         return Variable(tensor)
 
@@ -15,6 +22,168 @@ def to_scalar(var):
     return var.view(-1).data.tolist()[0]
 
 
+def concept_inputs(concept_table, p_id, target_p_id, x_result):
+    # gather the onehot inputs of a batch from the problem -> concept table
+    # c_id: concepts of the problem, shifted by num_concepts when it was solved, (bs, seqlen, 2 * num_concepts + 1)
+    # c_embed / target_c: concepts of the current / next problem, (bs, seqlen, num_concepts + 1)
+    # x_result: onehot of the current result, zero at the padding, (bs, seqlen, 2)
+    num_concepts = concept_table.shape[1] - 1
+    c_embed = concept_table[p_id]
+    target_c = concept_table[target_p_id]
+
+    x_result = x_result.unsqueeze(2)
+    c_id = F.pad(c_embed * (1 - x_result), (0, num_concepts)) + F.pad(c_embed * x_result, (num_concepts, 0))
+    x_result = torch.cat([1 - x_result, x_result], 2) * p_id.gt(0).unsqueeze(2)
+
+    return c_id, c_embed, target_c, x_result
+
+
+def distinct_codes(code_id):
+    # the distinct codes of a batch without the padding code 0, and the position of the code of every
+    # (row, step) cell among them; the padding cells get -1 and are not encoded
+    codes, code_index = np.unique(code_id, return_inverse=True)
+    code_index = code_index.reshape(code_id.shape)
+    if len(codes) and codes[0] == 0:
+        codes, code_index = codes[1:], code_index - 1
+    return codes, code_index
+
+
+def gather_codes(code_vectors, code_index):
+    # code_vectors[code_index] with zeros at the padding cells (code_index -1)
+    valid = code_index.ge(0)
+    out = code_vectors.new_zeros(code_index.shape + code_vectors.shape[1:])
+    out[valid] = code_vectors[code_index[valid]]
+    return out
+
+
+def run_lstm(lstm, lstm_input, lengths=None, status=None):
+    # a batch_first LSTM over the padded batch, or with the lengths of the sequences over packed sequences so
+    # no step past the end of a sequence is computed; the outputs there are zeros. With (bs, k) lengths every
+    # row holds k sequences one after the other (see pack_rows), each of them is run from a zero state.
+    # status is the initial state of the rows (zeros if None), the final state is returned with the outputs
+    if lengths is None:
+        return lstm(lstm_input, status)
+    if lengths.dim() > 1:
+        return run_lstm_rows(lstm, lstm_input, lengths)
+    packed_input = pack_padded_sequence(lstm_input, lengths, batch_first=True, enforce_sorted=False)
+    packed_out, final_status = lstm(packed_input, status)
+    lstm_out, _ = pad_packed_sequence(packed_out, batch_first=True, total_length=lstm_input.shape[1])
+    return lstm_out, final_status
+
+
+def run_lstm_rows(lstm, lstm_input, lengths):
+    # the LSTM over the packed rows of lstm_input, with the state of a row reset to zeros where one of its
+    # sequences starts, so the state never passes from a sequence to the next one of its row. The steps between
+    # two starts of a sequence in any row of the batch are run by one call; the outputs past the last sequence
+    # of a row are zeros
+    bs, seqlen = lstm_input.shape[:2]
+    keep = lengths > 0
+    rows = torch.arange(bs).unsqueeze(1).expand_as(lengths)[keep]
+    starts = (torch.cumsum(lengths, 1) - lengths)[keep]
+    ends = lengths.sum(1)
+    starting = torch.zeros(bs, seqlen, dtype=torch.bool)
+    starting[rows, starts] = True
+    bounds = starting.any(0).nonzero().view(-1).tolist() + [int(ends.max())]
+    starting = starting.to(lstm_input.device)
+
+    outputs = []
+    status = None
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if status is not None:
+            keep_state = starting[:, start].logical_not().to(lstm_input.dtype).view(1, -1, 1)
+            status = tuple(state * keep_state for state in status)
+        out, status = lstm(lstm_input[:, start:end], status)
+        outputs.append(out)
+
+    lstm_out = torch.cat(outputs, 1)
+    valid = torch.arange(lstm_out.shape[1]) < ends.unsqueeze(1)
+    lstm_out = lstm_out * valid.unsqueeze(2).to(lstm_out.device)
+    return F.pad(lstm_out, (0, 0, 0, seqlen - lstm_out.shape[1])), status
+
+
+def pack_rows(arrays, lengths, shuffle=False):
+    # packs the sequences of the (n, seqlen) arrays one after the other into as few rows as possible: the longest
+    # first, each into the fullest row it still fits in (best fit decreasing, sequences of the same length in a
+    # random order when shuffled). Returns the packed arrays and the (rows, k) lengths of the sequences of every
+    # packed row, 0 past its last one
+    seqlen = arrays[0].shape[1]
+    order = np.random.permutation(len(lengths)) if shuffle else np.arange(len(lengths))
+    order = order[np.argsort(-lengths[order], kind='stable')]
+
+    packed = []
+    # open_rows[free]: the packed rows with free empty steps
+    open_rows = [[] for _ in range(seqlen + 1)]
+    for seq in order:
+        length = lengths[seq]
+        free = next((free for free in range(length, seqlen) if open_rows[free]), None)
+        if free is None:
+            row = len(packed)
+            packed.append([])
+            free = seqlen
+        else:
+            row = open_rows[free].pop()
+        packed[row].append(seq)
+        open_rows[free - length].append(row)
+
+    # row, position in the row, start and length of every packed sequence
+    counts = np.array([len(row) for row in packed])
+    seqs = np.concatenate(packed)
+    rows = np.repeat(np.arange(len(packed)), counts)
+    positions = np.arange(len(seqs)) - np.repeat(np.cumsum(counts) - counts, counts)
+    packed_lengths = np.zeros((len(packed), counts.max()), dtype=np.int64)
+    packed_lengths[rows, positions] = lengths[seqs]
+    starts = (np.cumsum(packed_lengths, axis=1) - packed_lengths)[rows, positions]
+
+    # every step of every sequence and where it goes
+    seq_lengths = packed_lengths[rows, positions]
+    steps = np.arange(seq_lengths.sum()) - np.repeat(np.cumsum(seq_lengths) - seq_lengths, seq_lengths)
+    src_row = np.repeat(seqs, seq_lengths)
+    dst_row = np.repeat(rows, seq_lengths)
+    dst_step = np.repeat(starts, seq_lengths) + steps
+
+    packed_arrays = []
+    for array in arrays:
+        packed_array = np.zeros((len(packed), seqlen), dtype=array.dtype)
+        packed_array[dst_row, dst_step] = array[src_row, steps]
+        packed_arrays.append(packed_array)
+    return tuple(packed_arrays), packed_lengths
+
+
+def stateful_batches(chunk, batch_size, shuffle=False):
+    # row indices of batches whose k-th rows, the k-th lane, are rows of the students one after the other,
+    # chunk being the number of rows of the student before every row. Shuffled, the students are in a random
+    # order. The lanes are equal parts of the rows of all students, the last incomplete batch is dropped
+    student = np.cumsum(chunk == 0) - 1
+    rank = np.random.permutation(student[-1] + 1) if shuffle else np.arange(student[-1] + 1)
+    order = np.argsort(rank[student], kind='stable')
+    n = len(order) // batch_size * batch_size
+    return order[:n].reshape(batch_size, -1).T
+
+
+def carry_status(status, chunk, gpu):
+    # the final LSTM state of the last batch for the rows that continue the student of their lane (chunk > 0),
+    # zeros for the others. It is detached, so the gradient stops at the batch boundary (truncated BPTT)
+    if status is None:
+        return None
+    carry = variable(torch.as_tensor(chunk > 0, dtype=torch.float), gpu).view(1, -1, 1)
+    return tuple(state.detach() * carry for state in status)
+
+
+def bucket_batches(lengths, batch_size, shuffle=False, bucket_size=50):
+    # row indices of batches of sequences of similar lengths, the last incomplete batch is dropped as by the
+    # plain batching. Shuffled, the rows are permuted and cut into buckets of bucket_size batches, each bucket
+    # is sorted by length and the batches of all buckets are shuffled; otherwise the rows are sorted by length
+    n = len(lengths) // batch_size * batch_size
+    if not shuffle:
+        return np.argsort(lengths[:n], kind='stable').reshape(-1, batch_size)
+
+    order = np.random.permutation(len(lengths))[:n]
+    buckets = np.split(order, np.arange(bucket_size * batch_size, n, bucket_size * batch_size))
+    order = np.concatenate([bucket[np.argsort(lengths[bucket], kind='stable')] for bucket in buckets])
+    batches = order.reshape(-1, batch_size)
+    return batches[np.random.permutation(len(batches))]
+
+
 def save_checkpoint(state, track_list, filename):
     with open(filename + '.json', 'w') as f:
         json.dump(track_list, f)
@@ -24,3 +193,166 @@ def save_checkpoint(state, track_list, filename):
 def adjust_learning_rate(optimizer, lr):
     for param_group in optimizer.param_groups:
         param_group['lr'] = lr
+
+
+def file_hash(path, chunk_size=1 << 24):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def cache_path(path, *key):
+    # cache entries live next to the data file, keyed by its content and the loader settings
+    name = '_'.join([os.path.basename(path), file_hash(path)[:16]] + [str(k) for k in key])
+    return os.path.join(os.path.dirname(path), 'cache', name)
+
+
+def save_cache(cache_dir, data):
+    # every item is an array, so that load_cache can memory-map all of them
+    for i, item in enumerate(data):
+        if not isinstance(item, np.ndarray):
+            raise TypeError('cached item %d is a %s, not an array' % (i, type(item).__name__))
+    tmp_dir = '%s.tmp%d' % (cache_dir, os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    for i, item in enumerate(data):
+        np.save(os.path.join(tmp_dir, '%d.npy' % i), item)
+    try:
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        # another run has written the same entry in the meantime
+        for name in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, name))
+        os.rmdir(tmp_dir)
+
+
+def load_cache(cache_dir):
+    if not os.path.isdir(cache_dir):
+        return None
+    data = []
+    for name in sorted(os.listdir(cache_dir), key=lambda n: int(n.split('.')[0])):
+        data.append(np.load(os.path.join(cache_dir, name), mmap_mode='r'))
+    return tuple(data)
+
+
+def shuffle_buffer(items, buffer_size):
+    # approximate shuffle of a stream that only holds buffer_size items: every new item replaces
+    # a random one of the buffer, which is emitted
+    buffer = []
+    for item in items:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        k = np.random.randint(buffer_size)
+        yield buffer[k]
+        buffer[k] = item
+    np.random.shuffle(buffer)
+    for item in buffer:
+        yield item
+
+
+class RecordStream(IterableDataset):
+    # batches of a record file parsed while they are consumed, in the format of load_data (see stream_data
+    # of the loaders). Every iteration reads the file again, so one stream serves all epochs
+    def __init__(self, data, path, batch_size, buffer_size=0):
+        super(RecordStream, self).__init__()
+        self.data = data
+        self.path = path
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+
+    def __iter__(self):
+        return self.data.stream_data(self.path, self.batch_size, self.buffer_size)
+
+
+class BatchDataset(Dataset):
+    # the batches gather(rows, item) (run.gather_batch) of the items of run.batch_plan, collated into tensors by
+    # collate (run.collate_batch). The concept table, the last item of a collated batch, is None when it is the
+    # one of the last batch collated by the same process
+    def __init__(self, rows, gather, collate):
+        super(BatchDataset, self).__init__()
+        self.rows = rows
+        self.gather = gather
+        self.collate = collate
+        self.concept_source = None
+
+    def __getitem__(self, item):
+        collated = self.collate(self.gather(self.rows, item))
+        concept_array = collated[-1]
+        concept_source, self.concept_source = self.concept_source, concept_array
+        return collated[:-1] + (concept_array if concept_array is not concept_source else None,)
+
+
+def batch_loader(plan, gather, collate, params):
+    # the collated batches of the items of plan() (run.batch_plan), in order. The items are drawn in the main
+    # process, so the rows are shuffled, bucketed or packed once however many processes collate them. With
+    # params.batch_workers > 0 the items are handed to background processes that gather and collate their
+    # batches up to params.prefetch batches ahead of every worker, in pinned memory when the model is on the
+    # gpu; otherwise they are gathered and collated in the training loop
+    rows, items = plan()
+    dataset = BatchDataset(rows, gather, collate)
+    if params.batch_workers == 0:
+        return (dataset[item] for item in items)
+    return DataLoader(dataset, batch_size=None, sampler=items, num_workers=params.batch_workers,
+                      pin_memory=params.gpu >= 0, prefetch_factor=params.prefetch)
+
+
+class EpochMetrics():
+    # loss, accuracy and AUC of the predictions of an epoch, accumulated batch by batch on the device of the
+    # model and available at any time. With bins > 0 the scores of every label are counted in a histogram of
+    # bins equal bins of [0, 1], which holds in bounded memory and gives the AUC up to the ties inside a bin.
+    # With bins = 0 every batch is kept as a sorted run and the AUC is exact, the runs are merged by result()
+    def __init__(self, bins=0):
+        super(EpochMetrics, self).__init__()
+        self.bins = bins
+        self.loss = 0
+        self.batches = 0
+        self.correct = 0
+        self.count = 0
+        self.pos_hist = 0
+        self.neg_hist = 0
+        self.runs = []
+
+    def update(self, loss, pred, target):
+        pred = pred.detach()
+        self.loss = self.loss + loss.detach().double()
+        self.batches += 1
+        self.correct = self.correct + (pred.ge(0.5).float() == target).sum()
+        self.count += len(target)
+        if self.bins > 0:
+            bucket = (pred * self.bins).long().clamp(0, self.bins - 1)
+            positive = target.gt(0.5)
+            self.pos_hist = self.pos_hist + torch.bincount(bucket[positive], minlength=self.bins)
+            self.neg_hist = self.neg_hist + torch.bincount(bucket[~positive], minlength=self.bins)
+        else:
+            order = torch.argsort(pred)
+            self.runs.append((pred[order], target[order]))
+
+    def result(self):
+        # (loss, accuracy, auc) of the predictions so far
+        loss = (self.loss / self.batches).item()
+        accuracy = float(self.correct) / self.count
+        if self.bins > 0:
+            pos_hist = self.pos_hist.double()
+            neg_hist = self.neg_hist.double()
+            # the negatives of the lower bins, half of those of the same bin
+            below = torch.cumsum(neg_hist, 0) - neg_hist
+            pairs = (pos_hist * (below + 0.5 * neg_hist)).sum()
+            num_pos, num_neg = pos_hist.sum().item(), neg_hist.sum().item()
+        else:
+            # the stable sort of numpy merges the sorted runs
+            scores = torch.cat([run[0] for run in self.runs]).cpu().numpy()
+            labels = torch.cat([run[1] for run in self.runs]).cpu().numpy() > 0.5
+            order = np.argsort(scores, kind='stable')
+            scores, labels = scores[order], labels[order]
+            # average rank (from 1) of every group of equal scores
+            starts = np.flatnonzero(np.concatenate([[True], scores[1:] != scores[:-1]]))
+            ends = np.append(starts[1:], len(scores))
+            ranks = np.repeat((starts + ends + 1) / 2, ends - starts)
+            num_pos, num_neg = labels.sum(), (~labels).sum()
+            pairs = ranks[labels].sum() - num_pos * (num_pos + 1) / 2
+        if num_pos == 0 or num_neg == 0:
+            raise ValueError('Only one class present in y_true. ROC AUC score is not defined in that case.')
+        auc = float(pairs / (num_pos * num_neg))
+        return loss, accuracy, auc
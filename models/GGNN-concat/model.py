@@ -1,11 +1,10 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch_geometric.nn import MessagePassing,GatedGraphConv
+from torch_geometric.nn import GatedGraphConv
 from torch_geometric.nn.glob import GlobalAttention
 
 from utils import *
-import random
 
 class MODEL(nn.Module):
     def __init__(self, num_concepts, num_problems, hidden_dim, hidden_layers,
@@ -46,39 +45,29 @@ class MODEL(nn.Module):
         nn.init.constant_(self.predict_Linear.bias, 0)
 
 
-    def forward(self, p_id, c_id, node_id, edge, edge_type, target_c, result, c_embed, cur_result):
+    def forward(self, p_id, c_id, node_id, edge, edge_type, node_batch, code_index, num_codes, target_c, result, c_embed, cur_result, lengths=None, status=None):
         bs = p_id.shape[0]
         seqlen = p_id.shape[1]
-        nodelen = node_id.shape[2]
-
-        if self.num_nodes < 200:
-            sample = random.sample(range(0, node_id.shape[2]), 50)
-            nodelen = len(sample)
-            node_id = node_id[:, :, sample]
-            edge = edge[:, :, :, sample]
-            edge_type = edge_type[:, :, sample]
 
         #####################################################################################################
         # ggnn
-        node_embed = self.node_embed(node_id).view(bs, seqlen, nodelen, -1)
-        edge_weight = self.edge_embed(edge_type).mean(3).unsqueeze(3)
-
-        codevec = []
-        for i in range(bs):
-            for j in range(seqlen):
-                out = self.ggnnlayer(node_embed[i, j], edge[i, j], edge_weight[i, j])
-                gate = variable(torch.zeros(out.size(0), dtype=torch.long), self.gpu)
-                code_embedding = self.pool(out, batch=gate).squeeze(0)
-                codevec.append(code_embedding)
+        # node_id, edge and edge_type hold the graphs of the distinct codes of the batch merged into one graph,
+        # node_batch maps every node to one of the num_codes codes and code_index every (student, step) cell to its code
+        node_embed = self.node_embed(node_id)
+        edge_weight = self.edge_embed(edge_type).mean(1)
 
-        codevec = torch.cat([codevec[i].unsqueeze(0) for i in range(bs * seqlen)], 0).view(bs, seqlen, -1)
+        # the graphs are disjoint, so one convolution over the merged graph convolves each of them
+        out = self.ggnnlayer(node_embed, edge, edge_weight)
+        # attention pooling of every graph at once, node_batch assigns the nodes to their code. Padding and
+        # submissions without nodes get zeros
+        codevec = gather_codes(self.pool(out, batch=node_batch, size=num_codes), code_index)
 
         # PKT
         # p_id_embed = self.p_id_embed(p_id)
         LSTM_input = torch.cat([c_embed, codevec, cur_result], 2)
 
         # LSTM
-        LSTM_out, final_status = self.LSTM(LSTM_input)
+        LSTM_out, final_status = run_lstm(self.LSTM, LSTM_input, lengths, status)
         LSTM_out = LSTM_out.contiguous()
 
         #######################################################################################################
@@ -86,17 +75,17 @@ class MODEL(nn.Module):
 
         # 多知识点，除以知识点个数
         num_concepts = torch.sum(target_c, 2).view(-1)
-
-        prediction = self.predict_Linear(LSTM_out.view(bs * seqlen, -1))  # 去掉dropout
-        prediction_1d = torch.bmm(prediction.unsqueeze(1),
-                                  target_c.view(bs * seqlen, -1).unsqueeze(2)).squeeze(2)
+        # only the steps with a target problem are predicted
         mask = num_concepts.gt(0)
         num_concepts = torch.masked_select(num_concepts, mask)
-        filtered_pred = torch.masked_select(prediction_1d.squeeze(1), mask)
-        filtered_pred = torch.div(filtered_pred, num_concepts)
+
+        prediction = self.predict_Linear(LSTM_out.view(bs * seqlen, -1)[mask])  # 去掉dropout
+        prediction_1d = torch.bmm(prediction.unsqueeze(1),
+                                  target_c.view(bs * seqlen, -1)[mask].unsqueeze(2)).squeeze(2)
+        filtered_pred = torch.div(prediction_1d.squeeze(1), num_concepts)
         filtered_target = torch.masked_select(result.squeeze(1), mask)
         loss = F.binary_cross_entropy_with_logits(filtered_pred, filtered_target)
 
-        return loss, torch.sigmoid(filtered_pred), filtered_target
+        return loss, torch.sigmoid(filtered_pred), filtered_target, final_status
 
 
@@ -1,7 +1,6 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import random
 
 from utils import *
 
@@ -53,7 +52,7 @@ class MODEL(nn.Module):
         nn.init.kaiming_normal_(self.p_id_embed.weight)
 
 
-    def code2vec(self, paths, context_embedded, bs, seqlen):
+    def code2vec(self, paths, context_embedded, masks, bs, seqlen):
 
         num_paths = paths.shape[2]
 
@@ -65,18 +64,25 @@ class MODEL(nn.Module):
         attention_weight = torch.bmm(context_after_dense.view(bs * seqlen, num_paths, self.codevec_size),
                                      attention_weight.view(bs * seqlen, self.codevec_size, 1)).view(bs, seqlen,
                                                                                                     num_paths, 1)
+        # the padding contexts get no weight
+        attention_weight = attention_weight * masks.unsqueeze(3)
         # code_vectors = [bs, code_vector_size]
         code_vectors = torch.sum(torch.mul(context_after_dense, attention_weight.expand_as(context_after_dense)), dim=2)
 
         return code_vectors
 
-    def preprocess(self, paths, starts, ends):
-        # 取前n个path
-        if self.np < 200:
-            sample = random.sample(range(0, 200), self.np)
-            paths = paths[:, :, sample]
-            starts = starts[:, :, sample]
-            ends = ends[:, :, sample]
+    def preprocess(self, paths, starts, ends, masks):
+        # 取前n个path: np random contexts of every code, drawn from its own contexts (all of them if it has
+        # fewer), so the padding slots of a code do not depend on the other codes of the batch
+        num_paths = paths.shape[2]
+        if self.np < num_paths:
+            # random keys below 0 for the contexts of a code, the padding slots sort last
+            keys = torch.rand(masks.shape, device=masks.device) - masks
+            sample = torch.argsort(keys, dim=2)[:, :, :self.np]
+            paths = torch.gather(paths, 2, sample)
+            starts = torch.gather(starts, 2, sample)
+            ends = torch.gather(ends, 2, sample)
+            masks = torch.gather(masks, 2, sample)
         # paths = paths[:, :, :self.np]
         # starts = starts[:, :, :self.np]
         # ends = ends[:, :, :self.np]
@@ -91,10 +97,10 @@ class MODEL(nn.Module):
         context_embedded = self.dropout(context_embedded)
         context_embedded = self.cv_fc(context_embedded)
 
-        return context_embedded, starts, paths, ends, paths_embedded
+        return context_embedded, starts, paths, ends, masks, paths_embedded
 
 
-    def forward(self, p_id, c_id, starts, paths, ends, masks, target_c, result, c_embed, cur_result):
+    def forward(self, p_id, c_id, code_index, starts, paths, ends, masks, target_c, result, c_embed, cur_result, lengths=None, status=None):
         bs = p_id.shape[0]
         seqlen = p_id.shape[1]
 
@@ -103,14 +109,19 @@ class MODEL(nn.Module):
         # p_id_embed = self.p_id_embed(p_id)
 
         # code2vec模型
-        context_embedded, starts, paths, ends, paths_embedded = self.preprocess(paths, starts, ends)
-        code_vectors = self.code2vec(paths, context_embedded, bs, seqlen)
+        # starts, paths and ends hold the distinct codes of the batch, each is encoded once and
+        # code_index picks the code of every (student, step) cell
+        num_codes = paths.shape[0]
+        context_embedded, starts, paths, ends, masks, paths_embedded = self.preprocess(
+            paths.unsqueeze(0), starts.unsqueeze(0), ends.unsqueeze(0), masks.unsqueeze(0))
+        code_vectors = self.code2vec(paths, context_embedded, masks, 1, num_codes)
+        code_vectors = gather_codes(code_vectors.squeeze(0), code_index)
         LSTM_input = torch.cat([c_embed, code_vectors, cur_result], 2)
 
         # LSTM_input = torch.cat([c_embed, cur_result], 2)
 
         # LSTM
-        LSTM_out, final_status = self.LSTM(LSTM_input)
+        LSTM_out, final_status = run_lstm(self.LSTM, LSTM_input, lengths, status)
         LSTM_out = LSTM_out.contiguous()
 
         #######################################################################################################
@@ -118,17 +129,17 @@ class MODEL(nn.Module):
 
         # 多知识点，除以知识点个数
         num_concepts = torch.sum(target_c, 2).view(-1)
-
-        prediction = self.predict_Linear(LSTM_out.view(bs * seqlen, -1))  # 去掉dropout
-        prediction_1d = torch.bmm(prediction.unsqueeze(1),
-                                  target_c.view(bs * seqlen, -1).unsqueeze(2)).squeeze(2)
+        # only the steps with a target problem are predicted
         mask = num_concepts.gt(0)
         num_concepts = torch.masked_select(num_concepts, mask)
-        filtered_pred = torch.masked_select(prediction_1d.squeeze(1), mask)
-        filtered_pred = torch.div(filtered_pred, num_concepts)
+
+        prediction = self.predict_Linear(LSTM_out.view(bs * seqlen, -1)[mask])  # 去掉dropout
+        prediction_1d = torch.bmm(prediction.unsqueeze(1),
+                                  target_c.view(bs * seqlen, -1)[mask].unsqueeze(2)).squeeze(2)
+        filtered_pred = torch.div(prediction_1d.squeeze(1), num_concepts)
         filtered_target = torch.masked_select(result.squeeze(1), mask)
         loss = F.binary_cross_entropy_with_logits(filtered_pred, filtered_target)
 
-        return loss, torch.sigmoid(filtered_pred), filtered_target
+        return loss, torch.sigmoid(filtered_pred), filtered_target, final_status
 
 
@@ -2,39 +2,118 @@ import numpy as np
 from tqdm import tqdm
 import math
 import json
+import re
+import hashlib
+from itertools import chain, islice
+from multiprocessing import Pool
+
+import utils
+
+
+# a "source, path, target" entry of the path list of a submission, and the same with the spacing and
+# signs int() also accepts
+PATH_CONTEXT = re.compile(r'"\d+, \d+, \d+"')
+LOOSE_PATH_CONTEXT = re.compile(r'"\s*[+-]?\d+\s*, \s*[+-]?\d+\s*, \s*[+-]?\d+\s*"')
+PATH_SEPARATORS = str.maketrans('",+', '   ')
+
+
+def flatten(sequences, dtype=np.int64):
+    return np.fromiter(chain.from_iterable(sequences), dtype=dtype)
+
+
+def flat_lens(sequences):
+    # length of every element of every sequence
+    return np.fromiter((len(item) for seq in sequences for item in seq), dtype=np.int64)
+
+
+def flat_index(sequences):
+    # (row, step) position of every element of a list of sequences
+    lens = np.fromiter((len(seq) for seq in sequences), dtype=np.int64, count=len(sequences))
+    rows = np.repeat(np.arange(len(sequences)), lens)
+    steps = np.arange(lens.sum()) - np.repeat(np.cumsum(lens) - lens, lens)
+    return rows, steps
+
 
 class DATA_AST():
-    def __init__(self, num_concepts, seqlen, separate_char=';'):
+    # bump when the arrays returned by load_data change, invalidates old caches
+    cache_version = 7
+    # students per chunk handed to a parsing worker
+    chunk_size = 64
+
+    def __init__(self, num_concepts, seqlen, separate_char=';', use_cache=True, workers=1):
         super(DATA_AST, self).__init__()
 
         self.n_concept = num_concepts
         self.seqlen = seqlen
         self.separate_char = separate_char
+        self.use_cache = use_cache
+        self.workers = workers
 
     def load_data(self, path):
-        f_data = open(path, 'r')
-        seq_len_data = []
-        p_id_data = []
-        c_id_data = []
-        source_token_data = []
-        path_token_data = []
-        target_token_data = []
-        context_valid_masks_data = []
-        result_data = []
-        target_c_data = []
-        x_result_data = []
+        # parsed arrays are cached on disk and memory-mapped on later runs
+        if not self.use_cache:
+            return self.parse_data(path)
 
-        for lineID, line in enumerate(tqdm(f_data)):
+        cache_dir = utils.cache_path(path, 'AST', self.cache_version, self.seqlen, self.n_concept)
+        data = utils.load_cache(cache_dir)
+        if data is None:
+            data = self.parse_data(path)
+            utils.save_cache(cache_dir, data)
+        return data
 
-            # if lineID > 23:
-            #     continue
+    def parse_data(self, path):
+        if self.workers <= 1:
+            return self.build_arrays(*self.parse_codes(self.read_records(path)))
 
-            line = line.strip()
-            if lineID % 8 == 0:
-                line = line.split(',')
-                seq_len_data.append(int(line[1]))
+        # chunks of whole students are parsed in a process pool, imap returns them in file order so the
+        # arrays are the same as the serial ones
+        records = []
+        codes = {}
+        with Pool(self.workers) as pool:
+            for chunk_records, chunk_codes in tqdm(pool.imap(self.parse_chunk, self.read_chunks(path))):
+                records.extend(chunk_records)
+                codes.update(chunk_codes)
+        return self.build_arrays(records, codes)
+
+    def stream_data(self, path, batch_size, buffer_size=0):
+        # batches in the format of load_data, built while the file is read. The rows are shuffled through
+        # a buffer of buffer_size rows (0 keeps the file order), the last incomplete batch is dropped
+        rows = self.read_records(path)
+        if buffer_size > 0:
+            rows = utils.shuffle_buffer(rows, buffer_size)
+
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_size:
+                yield self.build_arrays(*self.parse_codes(batch))
+                batch = []
+
+    def read_records(self, path):
+        with open(path, 'r') as f_data:
+            for record in self.split_records(tqdm(f_data)):
+                yield record
+
+    def read_chunks(self, path):
+        # the lines of chunk_size students at a time
+        with open(path, 'r') as f_data:
+            while True:
+                lines = list(islice(f_data, 8 * self.chunk_size))
+                if not lines:
+                    return
+                yield lines
 
-            elif lineID % 8 == 1:
+    def parse_chunk(self, lines):
+        return self.parse_codes(self.split_records(lines))
+
+    def split_records(self, lines):
+        # every student takes 8 lines, yields its rows of at most seqlen + 1 interactions as
+        # (problem ids, concept tags, code texts, results, rows of the student before it), the codes are
+        # parsed by parse_codes
+        for lineID, line in enumerate(lines):
+
+            line = line.strip()
+            if lineID % 8 == 1:
                 problem_id = []
                 P = line.split(self.separate_char)
                 if len(P[len(P) - 1]) == 0:
@@ -53,32 +132,7 @@ class DATA_AST():
                     c_tags.append(tag)
 
             elif lineID % 8 == 4:
-                temp = line.split(self.separate_char)
-                source_tokens = []
-                path_tokens = []
-                target_tokens = []
-                context_valid_masks = []
-                for i in range(len(temp)):
-                    cur_source_tokens = []
-                    cur_path_tokens = []
-                    cur_target_tokens = []
-                    cur_context_masks = []
-                    temp[i] = json.loads(temp[i])
-                    for path in temp[i]:
-                        try:
-                            source_token, path_token, target_token = map(int, path.strip().split(', '))
-                        except:
-                            continue
-
-                        cur_source_tokens.append(source_token)
-                        cur_path_tokens.append(path_token)
-                        cur_target_tokens.append(target_token)
-                        cur_context_masks.append(1)
-
-                    source_tokens.append(cur_source_tokens)
-                    path_tokens.append(cur_path_tokens)
-                    target_tokens.append(cur_target_tokens)
-                    context_valid_masks.append(cur_context_masks)
+                codes = line.split(self.separate_char)
 
             elif lineID % 8 == 6:
                 result = []
@@ -95,14 +149,11 @@ class DATA_AST():
                     if len(problem_id) % new_seq_len:
                         n_split = n_split + 1
 
-
+                chunk = 0
                 for k in range(n_split):
                     p_id_sequence = []
                     c_id_sequence = []
-                    source_token_sequence = []
-                    path_token_sequence = []
-                    target_token_sequence = []
-                    context_valid_masks_sequence = []
+                    code_sequence = []
                     result_sequence = []
 
                     if k == n_split - 1:
@@ -113,85 +164,112 @@ class DATA_AST():
                         if problem_id[i] > 0:
                             p_id_sequence.append(int(problem_id[i]))
                             c_id_sequence.append(c_tags[i])
-                            source_token_sequence.append(source_tokens[i])
-                            path_token_sequence.append(path_tokens[i])
-                            target_token_sequence.append(target_tokens[i])
-                            context_valid_masks_sequence.append(context_valid_masks[i])
+                            code_sequence.append(codes[i])
                             result_sequence.append(result[i])
 
                     if len(p_id_sequence) > 2:
-                        p_id_data.append(p_id_sequence[:-1])
-                        c_id_data.append(c_id_sequence[:-1])
-                        source_token_data.append(source_token_sequence[:-1])
-                        path_token_data.append(path_token_sequence[:-1])
-                        target_token_data.append(target_token_sequence[:-1])
-                        context_valid_masks_data.append(context_valid_masks_sequence[:-1])
-                        result_data.append(result_sequence[1:])
-                        target_c_data.append(c_id_sequence[1:])
-                        x_result_data.append(result_sequence[:-1])
-
-        f_data.close()
-
-        p_id_dataArray = np.zeros((len(p_id_data), self.seqlen))
-        for i in range(len(p_id_data)):
-            dat = p_id_data[i]
-            p_id_dataArray[i, :len(dat)] = dat
-
-        # onehot形式
-        c_id_dataArray = np.zeros((len(c_id_data), self.seqlen, 2 * self.n_concept + 1))
-        for i in range(len(c_id_data)):
-            for j in range(len(c_id_data[i])):
-                for k in range(len(c_id_data[i][j])):
-                    c_id_dataArray[i, j, c_id_data[i][j][k] + x_result_data[i][j] * self.n_concept] = 1
-
-        c_embed_dataArray = np.zeros((len(c_id_data), self.seqlen, self.n_concept + 1))
-        for i in range(len(c_id_data)):
-            for j in range(len(c_id_data[i])):
-                for k in range(len(c_id_data[i][j])):
-                    c_embed_dataArray[i, j, c_id_data[i][j][k]] = 1
-
-        source_token_dataArray = np.zeros((len(source_token_data), self.seqlen, 200))
-        for i in range(len(source_token_data)):
-            for j in range(len(source_token_data[i])):
-                dat = source_token_data[i][j]
-                source_token_dataArray[i, j, :len(dat)] = dat
-
-        path_token_dataArray = np.zeros((len(path_token_data), self.seqlen, 200))
-        for i in range(len(path_token_data)):
-            for j in range(len(path_token_data[i])):
-                dat = path_token_data[i][j]
-                path_token_dataArray[i, j, :len(dat)] = dat
-
-        target_token_dataArray = np.zeros((len(target_token_data), self.seqlen, 200))
-        for i in range(len(target_token_data)):
-            for j in range(len(target_token_data[i])):
-                dat = target_token_data[i][j]
-                target_token_dataArray[i, j, :len(dat)] = dat
-
-        context_valid_mask_dataArray = np.zeros((len(context_valid_masks_data), self.seqlen, 200))
-        for i in range(len(context_valid_masks_data)):
-            for j in range(len(context_valid_masks_data[i])):
-                dat = context_valid_masks_data[i][j]
-                context_valid_mask_dataArray[i, j, :len(dat)] = dat
+                        yield p_id_sequence, c_id_sequence, code_sequence, result_sequence, chunk
+                        chunk += 1
+
+    def parse_codes(self, records):
+        # replaces the codes of the rows by their sha1, returns the rows and the parsed code of every sha1.
+        # identical submissions are parsed once
+        keyed_records = []
+        codes = {}
+        for p_id_sequence, c_id_sequence, code_sequence, result_sequence, chunk in records:
+            keys = []
+            for code in code_sequence[:-1]:
+                key = hashlib.sha1(code.encode()).digest()
+                if key not in codes:
+                    codes[key] = self.parse_code(code)
+                keys.append(key)
+            keyed_records.append((p_id_sequence, c_id_sequence, keys, result_sequence, chunk))
+        return keyed_records, codes
+
+    def parse_code(self, code):
+        # (source, path, target) contexts of a submission as an (n, 3) array, and the number of malformed
+        # paths that were skipped. The well-formed entries are matched in one pass over the text and their
+        # tokens converted by numpy, instead of decoding and splitting every path
+        n_paths = code.count('"') // 2
+        path_contexts = PATH_CONTEXT.findall(code)
+        if len(path_contexts) < n_paths:
+            path_contexts = LOOSE_PATH_CONTEXT.findall(code)
+
+        tokens = np.fromstring(''.join(path_contexts).translate(PATH_SEPARATORS), dtype=np.int32, sep=' ')
+        return tokens.reshape(-1, 3), n_paths - len(path_contexts)
+
+    def build_arrays(self, records, codes):
+        # the arrays of load_data from the rows and parsed codes of parse_codes
+        p_id_data = []
+        c_id_data = []
+        code_id_data = []
+        result_data = []
+        target_p_id_data = []
+        target_c_data = []
+        x_result_data = []
+        chunk_data = []
+        # table of distinct submissions, interactions only keep an index into it; code 0 is the padding
+        path_context_table = [np.zeros((0, 3), dtype=np.int32)]
+        malformed = 0
+        code_index = {}
+
+        for p_id_sequence, c_id_sequence, code_sequence, result_sequence, chunk in records:
+            code_ids = []
+            for key in code_sequence:
+                # identical submissions are stored once
+                if key not in code_index:
+                    code_index[key] = len(path_context_table)
+                    path_context_table.append(codes[key][0])
+                    malformed += codes[key][1]
+
+                code_ids.append(code_index[key])
+
+            p_id_data.append(p_id_sequence[:-1])
+            c_id_data.append(c_id_sequence[:-1])
+            code_id_data.append(code_ids)
+            result_data.append(result_sequence[1:])
+            target_p_id_data.append(p_id_sequence[1:])
+            target_c_data.append(c_id_sequence[1:])
+            x_result_data.append(result_sequence[:-1])
+            chunk_data.append(chunk)
+
+        # (row, step) of every interaction, shared by all per-step arrays
+        rows, steps = flat_index(p_id_data)
+
+        p_id_dataArray = np.zeros((len(p_id_data), self.seqlen), dtype=np.int32)
+        p_id_dataArray[rows, steps] = flatten(p_id_data)
+
+        target_p_id_dataArray = np.zeros((len(target_p_id_data), self.seqlen), dtype=np.int32)
+        target_p_id_dataArray[rows, steps] = flatten(target_p_id_data)
+
+        # the concept tags only depend on the problem: one multi-hot row per problem id, row 0 stays empty
+        # for the padding. The onehot inputs of the models are gathered from it per batch
+        p_ids = np.concatenate([flatten(p_id_data), flatten(target_p_id_data)])
+        n_tags = np.concatenate([flat_lens(c_id_data), flat_lens(target_c_data)])
+        tags = flatten(chain(chain.from_iterable(c_id_data), chain.from_iterable(target_c_data)))
+
+        concept_dataArray = np.zeros((p_ids.max(initial=0) + 1, self.n_concept + 1), dtype=np.uint8)
+        concept_dataArray[np.repeat(p_ids, n_tags), tags] = 1
 
+        # interaction (i, j) submitted code code_id_dataArray[i, j], whose ragged (source, path, target) contexts are
+        # path_context_dataArray[path_offset_dataArray[code]: path_offset_dataArray[code + 1]]
+        code_id_dataArray = np.zeros((len(code_id_data), self.seqlen), dtype=np.int32)
+        code_id_dataArray[rows, steps] = flatten(code_id_data)
+        path_offset_dataArray = np.concatenate([[0], np.cumsum([len(code) for code in path_context_table])])
+        path_context_dataArray = np.concatenate(path_context_table)
+        if malformed:
+            print('skipped %d malformed paths' % malformed)
 
         # target and label
-        target_c_dataArray = np.zeros((len(target_c_data), self.seqlen, self.n_concept + 1))
-        for i in range(len(target_c_data)):
-            for j in range(len(target_c_data[i])):
-                target_c_dataArray[i, j, target_c_data[i][j]] = 1
+        result_dataArray = np.zeros((len(result_data), self.seqlen), dtype=np.uint8)
+        result_dataArray[rows, steps] = flatten(result_data)
 
-        result_dataArray = np.zeros((len(result_data), self.seqlen))
-        for i in range(len(result_data)):
-            dat = result_data[i]
-            result_dataArray[i, :len(dat)] = dat
+        x_result_dataArray = np.zeros((len(x_result_data), self.seqlen), dtype=np.uint8)
+        x_result_dataArray[rows, steps] = flatten(x_result_data)
 
-        x_result_dataArray = np.zeros((len(x_result_data), self.seqlen, 2))
-        for i in range(len(x_result_data)):
-            for j in range(len(x_result_data[i])):
-                x_result_dataArray[i, j, x_result_data[i][j]] = 1
+        # the number of rows of the same student before every row, the rows of a student follow each other
+        chunk_dataArray = np.array(chunk_data, dtype=np.int32)
 
 
-        return p_id_dataArray, c_id_dataArray, source_token_dataArray, path_token_dataArray, \
-               target_token_dataArray, context_valid_mask_dataArray, \
-               target_c_dataArray, result_dataArray, c_embed_dataArray, x_result_dataArray
\ No newline at end of file
+        return p_id_dataArray, target_p_id_dataArray, code_id_dataArray, path_context_dataArray, path_offset_dataArray, \
+               result_dataArray, x_result_dataArray, chunk_dataArray, concept_dataArray
\ No newline at end of file
@@ -3,10 +3,19 @@ import argparse
 import numpy as np
 
 from load_data_AST import DATA_AST
-from run import train, test
+from run import train, test, typed_rows
 from model import MODEL
 import random
 import os
+import utils
+
+
+def load_split(data, params, path, buffer_size=0):
+    # the arrays of load_data with the rows of the model inputs typed once (see run.typed_rows), or a stream that
+    # parses the file batch by batch while training
+    if params.stream:
+        return utils.RecordStream(data, path, params.batch_size, buffer_size)
+    return typed_rows(data.load_data(path))
 
 
 # set random seed
@@ -28,12 +37,24 @@ def main(fold):
     parser.add_argument('--fold', type=int, default=fold)
     parser.add_argument('--dataset', type=str, default='codeforces')
     parser.add_argument('--set_seed', type=bool, default=True)
+    parser.add_argument('--use_cache', type=int, default=1)
+    parser.add_argument('--load_workers', type=int, default=1)
+    parser.add_argument('--stream', type=int, default=0)
+    parser.add_argument('--shuffle_buffer', type=int, default=1000)
+    parser.add_argument('--pack_lstm', type=int, default=1)
+    parser.add_argument('--bucket', type=int, default=0)
+    parser.add_argument('--pack_rows', type=int, default=0)
+    parser.add_argument('--stateful', type=int, default=0)
+    parser.add_argument('--batch_workers', type=int, default=0)
+    parser.add_argument('--prefetch', type=int, default=2)
+    parser.add_argument('--auc_bins', type=int, default=0)
     parser.add_argument('--batch_size', type=int, default=32)
     parser.add_argument('--init_lr', type=float, default=0.001)
     parser.add_argument('--weight_decay', type=float, default=0.00025)
     parser.add_argument('--concept_embed_dim', type=int, default=100)
     parser.add_argument('--codevec_size', type=int, default=128)
     parser.add_argument('--np', type=int, default=100)
+    parser.add_argument('--max_paths', type=int, default=200)
 
 
 
@@ -66,14 +87,13 @@ def main(fold):
 
 
     # load data
-    data = DATA_AST(num_concepts=params.num_concepts, seqlen=params.seqlen)
+    data = DATA_AST(num_concepts=params.num_concepts, seqlen=params.seqlen, use_cache=params.use_cache,
+                     workers=params.load_workers)
 
     print(train_path)
-    train_p_id, train_c_id, train_source_token, train_path_token, train_target_token, train_context_mask,\
-    train_target_c, train_result, train_c_embed, train_x_result = data.load_data(train_path)
+    train_data = load_split(data, params, train_path, params.shuffle_buffer)
     print(val_path)
-    val_p_id, val_c_id, val_source_token, val_path_token, val_target_token, val_context_mask,\
-    val_target_c, val_result, val_c_embed, val_x_result = data.load_data(val_path)
+    val_data = load_split(data, params, val_path)
 
     model = MODEL(num_concepts=params.num_concepts,
                   num_problems=params.num_problems,
@@ -99,15 +119,11 @@ def main(fold):
     best_valid_auc = 0
     count = 0
     for idx in range(params.EPOCH):
-        train_loss, train_accuracy, train_auc = train(model, params, optimizer, train_p_id, train_c_id,
-                                    train_source_token, train_path_token, train_target_token, train_context_mask,
-                                    train_target_c, train_result, train_c_embed, train_x_result)
+        train_loss, train_accuracy, train_auc = train(model, params, optimizer, train_data)
         print('Epoch %d/%d, loss : %3.5f, auc : %3.5f, accuracy : %3.5f' % (
             idx + 1, params.EPOCH, train_loss, train_auc, train_accuracy))
 
-        valid_loss, valid_accuracy, valid_auc = test(model, params, val_p_id, val_c_id, val_source_token,
-                                                     val_path_token, val_target_token, val_context_mask,
-                                                    val_target_c, val_result, val_c_embed, val_x_result)
+        valid_loss, valid_accuracy, valid_auc = test(model, params, val_data)
         print('Epoch %d/%d, valid auc : %3.5f, valid accuracy : %3.5f' % (
             idx + 1, params.EPOCH, valid_auc, valid_accuracy))
 
@@ -126,12 +142,9 @@ def main(fold):
 
 
     # test
-    test_p_id, test_c_id, test_source_token, test_path_token, test_target_token, test_context_mask, \
-    test_target_c, test_result, test_c_embed, test_x_result = data.load_data(test_path)
+    test_data = load_split(data, params, test_path)
 
-    test_loss, test_accuracy, test_auc = test(best_model, params, test_p_id, test_c_id, test_source_token,
-                                              test_path_token, test_target_token, test_context_mask,
-                                            test_target_c, test_result, test_c_embed, test_x_result)
+    test_loss, test_accuracy, test_auc = test(best_model, params, test_data)
     print('test auc : %3.5f, test accuracy : %3.5f' % (test_auc, test_accuracy))
 
     return best_train_auc, best_valid_auc, test_auc
@@ -1,7 +1,6 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import random
 
 from utils import *
 
@@ -55,13 +54,18 @@ class MODEL(nn.Module):
         nn.init.kaiming_normal_(self.p_id_embed.weight)
         nn.init.kaiming_normal_(self.transdim.weight)
 
-    def preprocess(self, paths, starts, ends):
-        # 取前n个path
-        if self.np < 200:
-            sample = random.sample(range(0, 200), self.np)
-            paths = paths[:, :, sample]
-            starts = starts[:, :, sample]
-            ends = ends[:, :, sample]
+    def preprocess(self, paths, starts, ends, masks):
+        # 取前n个path: np random contexts of every code, drawn from its own contexts (all of them if it has
+        # fewer), so the padding slots of a code do not depend on the other codes of the batch
+        num_paths = paths.shape[2]
+        if self.np < num_paths:
+            # random keys below 0 for the contexts of a code, the padding slots sort last
+            keys = torch.rand(masks.shape, device=masks.device) - masks
+            sample = torch.argsort(keys, dim=2)[:, :, :self.np]
+            paths = torch.gather(paths, 2, sample)
+            starts = torch.gather(starts, 2, sample)
+            ends = torch.gather(ends, 2, sample)
+            masks = torch.gather(masks, 2, sample)
 
         # Embedding
         starts_embedded = self.node_embedding(starts)
@@ -73,9 +77,9 @@ class MODEL(nn.Module):
         context_embedded = self.dropout(context_embedded)
         context_embedded = self.cv_fc(context_embedded)
 
-        return context_embedded, starts, paths, ends
+        return context_embedded, starts, paths, ends, masks
 
-    def attention(self, c_id, paths, c_embed, embedded, bs, seqlen):
+    def attention(self, c_id, paths, c_embed, embedded, masks, bs, seqlen):
         embedded = self.transdim(embedded)
 
         num_paths = paths.shape[2]
@@ -91,7 +95,10 @@ class MODEL(nn.Module):
         c_p_attn_weight = torch.bmm(concept_query.view(bs * seqlen, self.num_concepts + 1, self.concept_embed_dim),
                                     embedded.view(bs * seqlen, num_paths,
                                                   self.concept_embed_dim).permute(0, 2, 1))
-        c_p_attn_weight = torch.softmax(c_p_attn_weight, dim=2)
+        # padded context slots get no weight, cells without a code attend to nothing
+        context_mask = masks.view(bs * seqlen, 1, num_paths)
+        c_p_attn_weight = c_p_attn_weight.masked_fill(context_mask.eq(0), -1e9)
+        c_p_attn_weight = torch.softmax(c_p_attn_weight, dim=2) * context_mask
         c_p_attn_out = torch.bmm(c_p_attn_weight, embedded.view(bs * seqlen, num_paths, self.concept_embed_dim))
         c_p_attn_out = c_p_attn_out * c_embed.view(bs * seqlen, self.num_concepts + 1, self.concept_embed_dim)
         c_p_attn_out = torch.sum(c_p_attn_out, dim=1) / num.view(-1).unsqueeze(1)
@@ -100,7 +107,7 @@ class MODEL(nn.Module):
         return c_p_attn_out
 
 
-    def forward(self, p_id, c_id, starts, paths, ends, masks, target_c, result, c_embed, cur_result):
+    def forward(self, p_id, c_id, code_index, starts, paths, ends, masks, target_c, result, c_embed, cur_result, lengths=None, status=None):
         bs = p_id.shape[0]
         seqlen = p_id.shape[1]
 
@@ -109,12 +116,18 @@ class MODEL(nn.Module):
         # p_id_embed = self.p_id_embed(p_id)
 
         # code2vec模型
-        context_embedded, starts, paths, ends = self.preprocess(paths, starts, ends)
-        attn_out = self.attention(c_id, paths, c_embed, context_embedded, bs, seqlen)
+        # starts, paths and ends hold the distinct codes of the batch, their contexts are embedded once and
+        # code_index picks the code of every (student, step) cell
+        context_embedded, starts, paths, ends, masks = self.preprocess(
+            paths.unsqueeze(0), starts.unsqueeze(0), ends.unsqueeze(0), masks.unsqueeze(0))
+        context_embedded = gather_codes(context_embedded.squeeze(0), code_index)
+        paths = gather_codes(paths.squeeze(0), code_index)
+        masks = gather_codes(masks.squeeze(0), code_index)
+        attn_out = self.attention(c_id, paths, c_embed, context_embedded, masks, bs, seqlen)
         LSTM_input = torch.cat([c_embed, attn_out, cur_result], 2)
 
         # LSTM
-        LSTM_out, final_status = self.LSTM(LSTM_input)
+        LSTM_out, final_status = run_lstm(self.LSTM, LSTM_input, lengths, status)
         LSTM_out = LSTM_out.contiguous()
 
         #######################################################################################################
@@ -122,17 +135,17 @@ class MODEL(nn.Module):
 
         # 多知识点，除以知识点个数
         num_concepts = torch.sum(target_c, 2).view(-1)
-
-        prediction = self.predict_Linear(LSTM_out.view(bs * seqlen, -1))
-        prediction_1d = torch.bmm(prediction.unsqueeze(1),
-                                  target_c.view(bs * seqlen, -1).unsqueeze(2)).squeeze(2)
+        # only the steps with a target problem are predicted
         mask = num_concepts.gt(0)
         num_concepts = torch.masked_select(num_concepts, mask)
-        filtered_pred = torch.masked_select(prediction_1d.squeeze(1), mask)
-        filtered_pred = torch.div(filtered_pred, num_concepts)
+
+        prediction = self.predict_Linear(LSTM_out.view(bs * seqlen, -1)[mask])
+        prediction_1d = torch.bmm(prediction.unsqueeze(1),
+                                  target_c.view(bs * seqlen, -1)[mask].unsqueeze(2)).squeeze(2)
+        filtered_pred = torch.div(prediction_1d.squeeze(1), num_concepts)
         filtered_target = torch.masked_select(result.squeeze(1), mask)
         loss = F.binary_cross_entropy_with_logits(filtered_pred, filtered_target)
 
-        return loss, torch.sigmoid(filtered_pred), filtered_target
+        return loss, torch.sigmoid(filtered_pred), filtered_target, final_status
 
 
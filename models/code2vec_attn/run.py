@@ -1,132 +1,180 @@
 import math
+from functools import partial
 import numpy as np
 import torch
-from sklearn import metrics
 from tqdm import tqdm
 
 import utils as utils
 
-def train(model, params, optimizer, p_id, c_id, source_token, path_token, target_token, context_mask, \
-     target_c, result, c_embed, x_result):
+
+def collate_paths(path_context, path_offset, code_id, max_paths):
+    # pad the ragged path contexts of the distinct codes of a batch to their largest path count (at most max_paths),
+    # code_index maps every (row, step) cell to its code
+    codes, code_index = utils.distinct_codes(code_id)
+    start = path_offset[codes]
+    count = np.minimum(path_offset[codes + 1] - start, max_paths)
+    num_paths = max(int(count.max()), 1)
+
+    context_mask = np.arange(num_paths) < count[:, None]
+    contexts = np.zeros((len(codes), num_paths, 3), dtype=np.int32)
+    contexts[context_mask] = path_context[(start[:, None] + np.arange(num_paths))[context_mask]]
+
+    return contexts[:, :, 0], contexts[:, :, 1], contexts[:, :, 2], context_mask, code_index
+
+
+def batch_plan(params, data, shuffle=False):
+    # the batches of an epoch as the rows they are gathered from and one item per batch, see gather_batch. For
+    # the arrays of load_data an item is the (index, steps) of the rows of its batch, only these are drawn by
+    # the main process. The items of a utils.RecordStream are its batches themselves and the rows are None
+    if isinstance(data, utils.RecordStream):
+        return None, (batch + (np.count_nonzero(batch[0], axis=1),) for batch in data)
+
+    p_id, target_p_id, code_id, path_context, path_offset, result, x_result, chunk, concept_table = data
+    lengths = np.count_nonzero(p_id, axis=1)
+    rows = data + (lengths,)
+    steps = slice(None)
+
+    if params.stateful:
+        # the rows of the students one after the other in the same lane of the batches, so the LSTM state of
+        # a row can be carried to the next row of its student in the next batch
+        items = [(index, steps) for index in utils.stateful_batches(chunk, params.batch_size, shuffle)]
+        return rows, items
+
+    if params.pack_rows:
+        # several students one after the other in every row, the lengths are then (rows, students per row)
+        (p_id, target_p_id, code_id, result, x_result), lengths = utils.pack_rows(
+            (p_id, target_p_id, code_id, result, x_result), lengths, shuffle)
+        # a packed row continues no student
+        chunk = np.zeros(len(p_id), dtype=np.int32)
+        rows = p_id, target_p_id, code_id, path_context, path_offset, result, x_result, chunk, concept_table, lengths
 
     N = int(math.floor(len(p_id) / params.batch_size))
 
-    # shuffle data
-    shuffle_index = np.random.permutation(p_id.shape[0])
-    p_id = p_id[shuffle_index]
-    c_id = c_id[shuffle_index]
-    source_token = source_token[shuffle_index]
-    path_token = path_token[shuffle_index]
-    target_token = target_token[shuffle_index]
-    context_mask = context_mask[shuffle_index]
-    target_c = target_c[shuffle_index]
-    result = result[shuffle_index]
-    c_embed = c_embed[shuffle_index]
-    x_result = x_result[shuffle_index]
-
-    pred_list = []
-    target_list = []
+    if params.bucket:
+        # batches of students with similar sequence lengths, trimmed to their longest sequence
+        row_lengths = np.count_nonzero(p_id, axis=1)
+        items = [(index, slice(row_lengths[index].max()))
+                 for index in utils.bucket_batches(row_lengths, params.batch_size, shuffle)]
+        return rows, items
+
+    if shuffle:
+        # the rows of every batch are gathered through a permutation instead of permuting the arrays
+        batches = np.random.permutation(len(p_id))[:N * params.batch_size].reshape(N, params.batch_size)
+    else:
+        batches = [slice(idx * params.batch_size, (idx + 1) * params.batch_size) for idx in range(N)]
+    return rows, [(index, steps) for index in batches]
+
+
+def gather_batch(rows, item):
+    # the batch of an item of batch_plan in the format of load_data followed by the sequence lengths of its
+    # rows. The batches of slices of rows are views
+    if rows is None:
+        return item
+
+    p_id, target_p_id, code_id, path_context, path_offset, result, x_result, chunk, concept_table, lengths = rows
+    index, steps = item
+    return p_id[index, steps], \
+           target_p_id[index, steps], \
+           code_id[index, steps], \
+           path_context, \
+           path_offset, \
+           result[index, steps], \
+           x_result[index, steps], \
+           chunk[index], \
+           concept_table, \
+           lengths[index]
+
+
+def typed_rows(data):
+    # the arrays of load_data with the rows fed to the model converted once to the dtypes of its inputs, so
+    # collate_batch takes them as views instead of converting every batch
+    p_id, target_p_id, code_id, path_context, path_offset, result, x_result, chunk, concept_table = data
+    return p_id.astype(np.int64), target_p_id.astype(np.int64), code_id, path_context, path_offset, \
+           result.astype(np.float32), x_result.astype(np.float32), chunk, concept_table
+
+
+def collate_batch(params, batch):
+    # the model inputs of a batch of gather_batch as CPU tensors, followed by the lengths of the LSTM, the
+    # chunk of the rows and the concept table. Rows already of the dtype of a tensor are shared, not copied
+    p_id_seq, target_p_id_seq, code_id_seq, path_context, path_offset, result_seq, x_result_seq, chunk_seq, \
+    concept_array, length_seq = batch
+    source_token_seq, path_token_seq, target_token_seq, context_mask_seq, code_index_seq = collate_paths(
+        path_context, path_offset, code_id_seq, params.max_paths)
+
+    inputs = (torch.as_tensor(p_id_seq, dtype=torch.long),
+              torch.as_tensor(target_p_id_seq, dtype=torch.long),
+              torch.as_tensor(code_index_seq, dtype=torch.long),
+              torch.as_tensor(source_token_seq, dtype=torch.long),
+              torch.as_tensor(path_token_seq, dtype=torch.long),
+              torch.as_tensor(target_token_seq, dtype=torch.long),
+              torch.as_tensor(context_mask_seq, dtype=torch.float),
+              torch.as_tensor(result_seq, dtype=torch.float).view(-1, 1),
+              torch.as_tensor(x_result_seq, dtype=torch.float))
+    lengths = torch.as_tensor(length_seq) if params.pack_lstm or params.pack_rows else None
+    return inputs, lengths, chunk_seq, concept_array
+
+
+def train(model, params, optimizer, data):
+
+    # the LSTM state of the last batch, carried to the next one in the stateful mode
+    stateful = params.stateful and not isinstance(data, utils.RecordStream)
+    status = None
+
+    epoch_metrics = utils.EpochMetrics(params.auc_bins)
     model.train()
-    epoch_loss = 0
-
-    for idx in range(N):
-        p_id_seq = p_id[idx * params.batch_size: (idx + 1) * params.batch_size, :]
-        c_id_seq = c_id[idx * params.batch_size: (idx + 1) * params.batch_size, :]
-        source_token_seq = source_token[idx * params.batch_size: (idx + 1) * params.batch_size, :]
-        path_token_seq = path_token[idx * params.batch_size: (idx + 1) * params.batch_size, :]
-        target_token_seq = target_token[idx * params.batch_size: (idx + 1) * params.batch_size, :]
-        context_mask_seq = context_mask[idx * params.batch_size: (idx + 1) * params.batch_size, :]
-        target_c_seq = target_c[idx * params.batch_size: (idx + 1) * params.batch_size, :]
-        result_seq = result[idx * params.batch_size: (idx + 1) * params.batch_size, :]
-        c_embed_seq = c_embed[idx * params.batch_size: (idx + 1) * params.batch_size, :]
-        x_result_seq = x_result[idx * params.batch_size: (idx + 1) * params.batch_size, :]
-
-        input_p_id = utils.variable(torch.LongTensor(p_id_seq), params.gpu)
-        input_c_id = utils.variable(torch.FloatTensor(c_id_seq), params.gpu)
-        input_source_token = utils.variable(torch.LongTensor(source_token_seq), params.gpu)
-        input_path_token = utils.variable(torch.LongTensor(path_token_seq), params.gpu)
-        input_target_token = utils.variable(torch.LongTensor(target_token_seq), params.gpu)
-        input_context_mask = utils.variable(torch.FloatTensor(context_mask_seq), params.gpu)
-        input_target_c = utils.variable(torch.FloatTensor(target_c_seq), params.gpu)
-        input_result = utils.variable(torch.FloatTensor(result_seq), params.gpu).view(-1, 1)
-        input_c_embed = utils.variable(torch.FloatTensor(c_embed_seq), params.gpu)
-        input_x_result = utils.variable(torch.FloatTensor(x_result_seq), params.gpu)
+
+    batches = utils.batch_loader(partial(batch_plan, params, data, shuffle=True), gather_batch,
+                                 partial(collate_batch, params), params)
+    for batch in batches:
+        inputs, input_lengths, chunk_seq, concept_array = batch
+        if concept_array is not None:
+            # a new table, streamed batches come with their own
+            concept_table = utils.variable(torch.as_tensor(concept_array, dtype=torch.float), params.gpu)
+        input_p_id, input_target_p_id, input_code_index, input_source_token, input_path_token, input_target_token, \
+        input_context_mask, input_result, input_x_result = [utils.variable(x, params.gpu) for x in inputs]
+        input_c_id, input_c_embed, input_target_c, input_x_result = utils.concept_inputs(
+            concept_table, input_p_id, input_target_p_id, input_x_result)
+        input_status = utils.carry_status(status, chunk_seq, params.gpu) if stateful else None
 
         model.zero_grad()
-        loss, filtered_pred, filtered_target = model(input_p_id, input_c_id, input_source_token,
+        loss, filtered_pred, filtered_target, status = model(input_p_id, input_c_id, input_code_index, input_source_token,
                                     input_path_token, input_target_token, input_context_mask,
-                                    input_target_c, input_result, input_c_embed, input_x_result)
+                                    input_target_c, input_result, input_c_embed, input_x_result,
+                                    input_lengths, input_status)
         loss.backward()
 
         optimizer.step()
-        epoch_loss += utils.to_scalar(loss)
-
-        right_target = np.asarray(filtered_target.data.tolist())
-        right_pred = np.asarray(filtered_pred.data.tolist())
-        pred_list.append(right_pred)
-        target_list.append(right_target)
+        epoch_metrics.update(loss, filtered_pred, filtered_target)
 
-    all_pred = np.concatenate(pred_list, axis=0)
-    all_target = np.concatenate(target_list, axis=0)
+    return epoch_metrics.result()
 
-    auc = metrics.roc_auc_score(all_target, all_pred)
-    all_pred[all_pred >= 0.5] = 1.0
-    all_pred[all_pred < 0.5] = 0.0
-    accuracy = metrics.accuracy_score(all_target, all_pred)
 
-    return epoch_loss / N, accuracy, auc
+def test(model, params, data):
 
+    # the LSTM state of the last batch, carried to the next one in the stateful mode
+    stateful = params.stateful and not isinstance(data, utils.RecordStream)
+    status = None
 
-def test(model, params, p_id, c_id, source_token, path_token, target_token, context_mask, \
-     target_c, result, c_embed, x_result):
-
-    N = int(math.floor(len(p_id) / params.batch_size))
-
-    pred_list = []
-    target_list = []
+    epoch_metrics = utils.EpochMetrics(params.auc_bins)
     model.eval()
-    epoch_loss = 0
-
-    for idx in range(N):
-        p_id_seq = p_id[idx * params.batch_size: (idx + 1) * params.batch_size, :]
-        c_id_seq = c_id[idx * params.batch_size: (idx + 1) * params.batch_size, :]
-        source_token_seq = source_token[idx * params.batch_size: (idx + 1) * params.batch_size, :]
-        path_token_seq = path_token[idx * params.batch_size: (idx + 1) * params.batch_size, :]
-        target_token_seq = target_token[idx * params.batch_size: (idx + 1) * params.batch_size, :]
-        context_mask_seq = context_mask[idx * params.batch_size: (idx + 1) * params.batch_size, :]
-        target_c_seq = target_c[idx * params.batch_size: (idx + 1) * params.batch_size, :]
-        result_seq = result[idx * params.batch_size: (idx + 1) * params.batch_size, :]
-        c_embed_seq = c_embed[idx * params.batch_size: (idx + 1) * params.batch_size, :]
-        x_result_seq = x_result[idx * params.batch_size: (idx + 1) * params.batch_size, :]
-
-        input_p_id = utils.variable(torch.LongTensor(p_id_seq), params.gpu)
-        input_c_id = utils.variable(torch.FloatTensor(c_id_seq), params.gpu)
-        input_source_token = utils.variable(torch.LongTensor(source_token_seq), params.gpu)
-        input_path_token = utils.variable(torch.LongTensor(path_token_seq), params.gpu)
-        input_target_token = utils.variable(torch.LongTensor(target_token_seq), params.gpu)
-        input_context_mask = utils.variable(torch.FloatTensor(context_mask_seq), params.gpu)
-        input_target_c = utils.variable(torch.FloatTensor(target_c_seq), params.gpu)
-        input_result = utils.variable(torch.FloatTensor(result_seq), params.gpu).view(-1, 1)
-        input_c_embed = utils.variable(torch.FloatTensor(c_embed_seq), params.gpu)
-        input_x_result = utils.variable(torch.FloatTensor(x_result_seq), params.gpu)
-
-
-        loss, filtered_pred, filtered_target = model(input_p_id, input_c_id, input_source_token,
-                                    input_path_token, input_target_token, input_context_mask,
-                                    input_target_c, input_result, input_c_embed, input_x_result)
-        epoch_loss += utils.to_scalar(loss)
 
-        right_target = np.asarray(filtered_target.data.tolist())
-        right_pred = np.asarray(filtered_pred.data.tolist())
-        pred_list.append(right_pred)
-        target_list.append(right_target)
+    batches = utils.batch_loader(partial(batch_plan, params, data), gather_batch, partial(collate_batch, params), params)
+    for batch in batches:
+        inputs, input_lengths, chunk_seq, concept_array = batch
+        if concept_array is not None:
+            # a new table, streamed batches come with their own
+            concept_table = utils.variable(torch.as_tensor(concept_array, dtype=torch.float), params.gpu)
+        input_p_id, input_target_p_id, input_code_index, input_source_token, input_path_token, input_target_token, \
+        input_context_mask, input_result, input_x_result = [utils.variable(x, params.gpu) for x in inputs]
+        input_c_id, input_c_embed, input_target_c, input_x_result = utils.concept_inputs(
+            concept_table, input_p_id, input_target_p_id, input_x_result)
+        input_status = utils.carry_status(status, chunk_seq, params.gpu) if stateful else None
 
-    all_pred = np.concatenate(pred_list, axis=0)
-    all_target = np.concatenate(target_list, axis=0)
 
-    auc = metrics.roc_auc_score(all_target, all_pred)
-    all_pred[all_pred >= 0.5] = 1.0
-    all_pred[all_pred < 0.5] = 0.0
-    accuracy = metrics.accuracy_score(all_target, all_pred)
+        loss, filtered_pred, filtered_target, status = model(input_p_id, input_c_id, input_code_index, input_source_token,
+                                    input_path_token, input_target_token, input_context_mask,
+                                    input_target_c, input_result, input_c_embed, input_x_result,
+                                    input_lengths, input_status)
+        epoch_metrics.update(loss, filtered_pred, filtered_target)
 
-    return epoch_loss / N, accuracy, auc
\ No newline at end of file
+    return epoch_metrics.result()
\ No newline at end of file